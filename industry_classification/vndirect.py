@@ -17,37 +17,298 @@
 
 # TODO: How to deal with a Vietnamese name query?
 
+import asyncio
+import atexit
+import contextlib
+import functools
+import itertools
 import random
 import logging
+import math
+import sys
+import threading
 import urllib.parse
-from copy import deepcopy
-from typing import List, Tuple, Literal
+from typing import List, Optional, Tuple, Literal
 import httpx
 import pandas
+import requests
+from cachetools import TTLCache, cached
 import vnquant.DataLoader as vnd_loader
+from requests.adapters import HTTPAdapter
 from common.configs import USER_AGENTS
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    try:
+        from msgspec.json import decode as _json_loads
+    except ImportError:
+        from json import loads as _json_loads
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import rusty_req
+except ImportError:
+    rusty_req = None
+
 
 # Constants
 # Susceptible to API change
 CONTENT_TYPE = "application/json"
+ACCEPT_ENCODING = "br, gzip"
 MAX_QUERY_SIZE = 9999
 BASE_URL = "https://finfo-api.vndirect.com.vn/v4/industry_classification"
-PAYLOAD_Q_KEYS = {
-    'codeList': "",
-    'industryCode': "",
-    'industryLevel': "",
-    'higherLevelCode': "",
-    'englishName': "",
-    'vietnameseName': ""
-}
+IND_DTYPES = {
+    'industryCode': "string",
+    'industryLevel': "int8",
+    'higherLevelCode': "string",
+    'englishName': "string",
+    'vietnameseName': "string",
+    'codeList': "string"
+} # Column dtypes of industry records; other columns are inferred
 PAYLOAD_Q_JOIN_CHAR = "~"
-BASE_PAYLOAD = {
-    'q': "",
-    'size': ""
-}
-PAYLOAD_SAFE_CHARS = ":," # Not to encode these in query param
+PAYLOAD_SAFE_CHARS = ":,~" # Not to encode these in query param
 DEFAULT_INDUSTRY_LEVEL = 1 # Default industry level
+DEFAULT_CONCURRENCY = 8 # Max in-flight requests in a batch
+FETCH_CACHE_SIZE = 128 # Max distinct queries to keep raw responses for
+CODE_LIST_CHUNK_SIZE = 200 # Max tickers per request, to keep the URL short
+PRICE_POOL_SIZE = 32 # Max pooled connections per host for price downloads
+BATCH_TIMEOUT = 60 # Seconds to wait for a whole batch of queries
+FULL_CACHE_TTL = 6 * 3600 # Seconds to keep the full industry classification for
+
+# User agents are shuffled once, then rotated through per request
+_UA_CYCLE = itertools.cycle(random.sample(USER_AGENTS, len(USER_AGENTS)))
+
+# Shared HTTP client so that connections to the API are pooled
+#   and kept alive across calls instead of being opened per request
+# HTTP/2 lets concurrent requests share one connection
+_CLIENT_HEADERS = {
+    'content-type': CONTENT_TYPE,
+    'accept-encoding': ACCEPT_ENCODING
+}
+_CLIENT_LIMITS = httpx.Limits(max_keepalive_connections=10, max_connections=20)
+_CLIENT = httpx.Client(
+    headers=_CLIENT_HEADERS,
+    limits=_CLIENT_LIMITS,
+    http2=True
+)
+
+
+def close_client():
+    '''Closes the shared HTTP client and its pooled connections
+    '''
+
+    _CLIENT.close()
+
+
+atexit.register(close_client)
+
+# Shared requests session for price downloads,
+#   which vnquant makes with one request per ticker
+_PRICE_ADAPTER = HTTPAdapter(pool_connections=PRICE_POOL_SIZE, pool_maxsize=PRICE_POOL_SIZE)
+_PRICE_SESSION = requests.Session()
+_PRICE_SESSION.mount('https://', _PRICE_ADAPTER)
+_PRICE_SESSION.mount('http://', _PRICE_ADAPTER)
+atexit.register(_PRICE_SESSION.close)
+# vnquant's loaders get patched to use the session while any download runs;
+#   the lock and count keep overlapping downloads from clobbering each other
+_PRICE_PATCH_LOCK = threading.Lock()
+_PRICE_PATCH_COUNT = 0
+_PRICE_PATCHED_MODULES = []
+
+# Shared async HTTP client; created lazily and tied to
+#   the event loop that created it, since its connections belong to that loop
+_ACLIENT: Optional[httpx.AsyncClient] = None
+_ACLIENT_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    '''Gets the shared async HTTP client for the running event loop,
+    creating it if needed; must be called from inside a coroutine
+    '''
+
+    global _ACLIENT, _ACLIENT_LOOP
+    loop = asyncio.get_running_loop()
+    if _ACLIENT is None or _ACLIENT.is_closed or _ACLIENT_LOOP is not loop:
+        _ACLIENT = httpx.AsyncClient(
+            headers=_CLIENT_HEADERS,
+            limits=_CLIENT_LIMITS,
+            http2=True
+        )
+        _ACLIENT_LOOP = loop
+    return _ACLIENT
+
+
+async def aclose_async_client():
+    '''Closes the shared async HTTP client;
+    should be awaited before its event loop is closed
+    '''
+
+    global _ACLIENT, _ACLIENT_LOOP
+    if _ACLIENT is not None:
+        await _ACLIENT.aclose()
+        _ACLIENT = None
+        _ACLIENT_LOOP = None
+
+
+def _build_payload(
+        code_list: List[str]=None,
+        industry_codes: List[str]=None,
+        higher_level_codes: List[str]=None,
+        english_name: str="",
+        vietnamese_name: str="",
+        result_size: int=MAX_QUERY_SIZE
+    ) -> Tuple[str, dict]:
+    '''Builds the query param string and headers for a request
+
+    :returns:
+        - str: the encoded query param string
+        - dict: the request headers
+    '''
+
+    # Construct a single string containing all non-empty keys
+    #   for the 'q' parameter
+    # Then quote it using the payload safe chars
+    payload_q_keys = {
+        'codeList': ",".join(code_list or ()),
+        'industryCode': ",".join(industry_codes or ()),
+        'industryLevel': DEFAULT_INDUSTRY_LEVEL,
+        'higherLevelCode': ",".join(higher_level_codes or ()),
+        'englishName': english_name,
+        'vietnameseName': vietnamese_name
+    }
+    payload_q_str = PAYLOAD_Q_JOIN_CHAR.join(
+        [f"{key}:{value}" for key, value in payload_q_keys.items() if value != ""]
+    )
+    payload_q_str = urllib.parse.quote(payload_q_str, safe=PAYLOAD_SAFE_CHARS)
+
+    payload_str = f"q={payload_q_str}&size={result_size}"
+    headers = {
+        'User-Agent': next(_UA_CYCLE)
+    }
+
+    return payload_str, headers
+
+
+def _to_dataframe(data: List[dict]) -> pandas.DataFrame:
+    '''Builds a DataFrame from the industry records of a response;
+    goes through a pyarrow Table when pyarrow is available,
+    keeping the columns Arrow-backed
+
+    Known columns are cast to the types in IND_DTYPES
+    '''
+
+    if pyarrow is None or not data:
+        industry_df = pandas.DataFrame(data)
+        for column, dtype in IND_DTYPES.items():
+            if column not in industry_df:
+                continue
+            if dtype.startswith("int"):
+                # Integers may come as strings and may be missing,
+                #   so parse them and use the nullable dtype (e.g. Int8),
+                #   matching the pyarrow path
+                industry_df[column] = pandas.to_numeric(industry_df[column]).astype(
+                    dtype.capitalize()
+                )
+            else:
+                industry_df[column] = industry_df[column].astype(dtype)
+        return industry_df
+
+    # Infer the struct type over all records rather than just the first,
+    #   as some keys (e.g. higherLevelCode) are missing on some records
+    table = pyarrow.Table.from_struct_array(pyarrow.array(data))
+    schema = pyarrow.schema([
+        field.with_type(pyarrow.type_for_alias(IND_DTYPES[field.name]))
+        if field.name in IND_DTYPES else field
+        for field in table.schema
+    ])
+    return table.cast(schema).to_pandas(types_mapper=pandas.ArrowDtype)
+
+
+def _parse_response(content: bytes) -> Tuple[pandas.DataFrame, dict]:
+    '''Parses the body of a response from the API
+
+    :returns:
+        - DataFrame: pandas DataFrame of industry classification
+        - Metadata: metadata dictionary about the request
+    '''
+
+    # Put industry data from the JSON response into a DataFrame
+    # Metadata is everything else other than industry data
+    resp_json = _json_loads(content)
+    data = resp_json.pop('data', [])
+    metadata_dict = resp_json
+    industry_df = _to_dataframe(data)
+
+    return industry_df, metadata_dict
+
+
+def _chunks(seq: List[str], n: int):
+    '''Splits a sequence into lists of at most n items
+    '''
+
+    it = iter(seq)
+    return iter(lambda: list(itertools.islice(it, n)), [])
+
+
+def _combine_results(
+        results: List[Tuple[pandas.DataFrame, dict]]
+    ) -> Tuple[pandas.DataFrame, dict]:
+    '''Combines the results of chunked queries into one result;
+    an industry matched by several chunks is kept once,
+    and metadata is the first non-empty chunk's
+    with totalElements and totalPages recounted
+    '''
+
+    industry_df = pandas.concat([df for df, _ in results], ignore_index=True)
+    if 'industryCode' in industry_df:
+        industry_df = industry_df.drop_duplicates(subset='industryCode', ignore_index=True)
+    metadata_dict = dict(next(
+        (metadata for df, metadata in results if len(df)),
+        results[0][1]
+    ))
+    metadata_dict['totalElements'] = len(industry_df)
+    if metadata_dict.get('size'):
+        metadata_dict['totalPages'] = math.ceil(len(industry_df) / metadata_dict['size'])
+
+    return industry_df, metadata_dict
+
+
+@functools.lru_cache(maxsize=FETCH_CACHE_SIZE)
+def _fetch_raw(
+        code_list: Tuple[str, ...],
+        industry_codes: Tuple[str, ...],
+        higher_level_codes: Tuple[str, ...],
+        english_name: str,
+        vietnamese_name: str,
+        result_size: int
+    ) -> bytes:
+    '''Requests the API and returns the raw response body;
+    memoized, so list args must be passed as tuples
+    '''
+
+    payload_str, headers = _build_payload(
+        code_list=code_list,
+        industry_codes=industry_codes,
+        higher_level_codes=higher_level_codes,
+        english_name=english_name,
+        vietnamese_name=vietnamese_name,
+        result_size=result_size
+    )
+    # The query string is already encoded, so it is sent as part of the URL;
+    #   passing it as params would make httpx parse and re-encode it
+    resp = _CLIENT.get(
+        f"{BASE_URL}?{payload_str}",
+        headers=headers
+    )
+    resp.raise_for_status()
+
+    return resp.content
+
 
 def get_ind_class(
         code_list: List[str]=None,
@@ -71,56 +332,269 @@ def get_ind_class(
     :returns:
         - DataFrame: pandas DataFrame of industry classification
         - Metadata: metadata dictionary about the request
+
+    A code_list longer than CODE_LIST_CHUNK_SIZE is queried in chunks,
+    whose results are combined
+
+    Raw responses are cached per distinct query;
+    use get_ind_class.cache_clear() to drop them
     '''
 
-    # Prepare payload
-    # Construct a single string containing all keys for the 'q' parameter
+    if code_list and len(code_list) > CODE_LIST_CHUNK_SIZE:
+        return _combine_results([
+            get_ind_class(
+                code_list=chunk,
+                industry_codes=industry_codes,
+                higher_level_codes=higher_level_codes,
+                english_name=english_name,
+                vietnamese_name=vietnamese_name,
+                result_size=result_size
+            )
+            for chunk in _chunks(code_list, CODE_LIST_CHUNK_SIZE)
+        ])
 
-    # Parse the payload dict using the payload safe chars
+    content = _fetch_raw(
+        tuple(code_list or ()),
+        tuple(industry_codes or ()),
+        tuple(higher_level_codes or ()),
+        english_name,
+        vietnamese_name,
+        result_size
+    )
 
-    # Process the JSON response
-    # Then put industry data from it into a DataFrame
-    # Metadata is everything else other than industry data
-    payload = deepcopy(BASE_PAYLOAD)
-    payload_q_keys = deepcopy(PAYLOAD_Q_KEYS)
-    payload_q_keys['industryLevel'] = DEFAULT_INDUSTRY_LEVEL
-    if code_list:
-        payload_q_keys['codeList'] = ",".join(code_list)
-    if industry_codes:
-        payload_q_keys['industryCode'] = ",".join(industry_codes)
-    if higher_level_codes:
-        payload_q_keys['higherLevelCode'] = ",".join(higher_level_codes)
-    payload_q_keys['englishName'] = english_name
-    payload_q_keys['englishName'] = vietnamese_name
-    payload_q_str = PAYLOAD_Q_JOIN_CHAR.join(
-        [f"{key}:{value}" for key, value in payload_q_keys.items()]
+    return _parse_response(content)
+
+
+get_ind_class.cache_clear = _fetch_raw.cache_clear
+
+
+async def _aget_ind_class(
+        sem: asyncio.Semaphore,
+        code_list: List[str]=None,
+        industry_codes: List[str]=None,
+        higher_level_codes: List[str]=None,
+        english_name: str="",
+        vietnamese_name: str="",
+        result_size: int=MAX_QUERY_SIZE
+    ) -> Tuple[pandas.DataFrame, dict]:
+    '''Queries the API with the shared async client;
+    each request, including one per chunk of a long code_list,
+    holds the semaphore while in flight
+    '''
+
+    if code_list and len(code_list) > CODE_LIST_CHUNK_SIZE:
+        return _combine_results(await asyncio.gather(*(
+            _aget_ind_class(
+                sem,
+                code_list=chunk,
+                industry_codes=industry_codes,
+                higher_level_codes=higher_level_codes,
+                english_name=english_name,
+                vietnamese_name=vietnamese_name,
+                result_size=result_size
+            )
+            for chunk in _chunks(code_list, CODE_LIST_CHUNK_SIZE)
+        )))
+
+    payload_str, headers = _build_payload(
+        code_list=code_list,
+        industry_codes=industry_codes,
+        higher_level_codes=higher_level_codes,
+        english_name=english_name,
+        vietnamese_name=vietnamese_name,
+        result_size=result_size
     )
-    payload['q'] = payload_q_str
-    payload['size'] = result_size
+    async with sem:
+        resp = await get_async_client().get(
+            f"{BASE_URL}?{payload_str}",
+            headers=headers
+        )
+    resp.raise_for_status()
 
-    payload_str = urllib.parse.urlencode(payload, safe=PAYLOAD_SAFE_CHARS)
-    headers = {
-        'content-type': CONTENT_TYPE,
-        'User-Agent': random.choice(USER_AGENTS)
-    }
-    resp = httpx.get(
-        BASE_URL,
-        params=payload_str,
-        headers=headers
+    return _parse_response(resp.content)
+
+
+async def aget_ind_class(
+        code_list: List[str]=None,
+        industry_codes: List[str]=None,
+        higher_level_codes: List[str]=None,
+        english_name: str="",
+        vietnamese_name: str="",
+        result_size: int=MAX_QUERY_SIZE
+    ) -> Tuple[pandas.DataFrame, dict]:
+    '''Async version of get_ind_class, using the shared async client;
+    takes the same params and returns the same results
+
+    Chunks of a long code_list are queried concurrently,
+    at most DEFAULT_CONCURRENCY at a time
+    '''
+
+    return await _aget_ind_class(
+        asyncio.Semaphore(DEFAULT_CONCURRENCY),
+        code_list=code_list,
+        industry_codes=industry_codes,
+        higher_level_codes=higher_level_codes,
+        english_name=english_name,
+        vietnamese_name=vietnamese_name,
+        result_size=result_size
     )
 
-    resp_json = resp.json()
-    industry_df = pandas.DataFrame(resp_json['data'])
-    metadata_dict = {key: value for key, value in resp_json.items() if key != 'data'}
 
-    return industry_df, metadata_dict
+async def aget_ind_class_many(
+        queries: List[dict],
+        concurrency: int=DEFAULT_CONCURRENCY
+    ) -> List[Tuple[pandas.DataFrame, dict]]:
+    '''Runs many industry queries concurrently
+
+    :params:
+        @queries: list of dict - keyword arguments for aget_ind_class,
+            one dict per query
+        @concurrency: int - the max number of requests in flight at once,
+            counting each chunk of a long code_list as a request
+
+    :returns:
+        - list of (DataFrame, Metadata) tuples, in the same order as queries
+    '''
+
+    sem = asyncio.Semaphore(concurrency)
+
+    return await asyncio.gather(*(_aget_ind_class(sem, **query) for query in queries))
+
+
+def get_ind_class_batch_rusty(
+        queries: List[dict],
+        total_timeout: float=BATCH_TIMEOUT
+    ) -> List[Tuple[pandas.DataFrame, dict]]:
+    '''Runs many industry queries at once with rusty_req,
+    which sends them all from native code;
+    falls back to aget_ind_class_many if rusty_req is not installed
+
+    Written against the response layout of rusty-req 0.4.27
+
+    :params:
+        @queries: list of dict - keyword arguments for get_ind_class,
+            one dict per query; code_list is not chunked here
+        @total_timeout: float - seconds to wait for the whole batch
+
+    :returns:
+        - list of (DataFrame, Metadata) tuples, in the same order as queries
+    '''
+
+    if rusty_req is None:
+        async def _run():
+            try:
+                return await aget_ind_class_many(queries)
+            finally:
+                await aclose_async_client()
+
+        return asyncio.run(_run())
+
+    request_items = [
+        rusty_req.RequestItem(
+            url=f"{BASE_URL}?{payload_str}",
+            method="GET",
+            headers={**_CLIENT_HEADERS, **headers},
+            timeout=total_timeout,
+            tag=str(index)
+        )
+        for index, (payload_str, headers) in enumerate(
+            _build_payload(**query) for query in queries
+        )
+    ]
 
+    # fetch_requests needs a running event loop when it is called,
+    #   not just when it is awaited
+    async def _run():
+        return await rusty_req.fetch_requests(
+            request_items,
+            total_timeout=total_timeout,
+            mode=rusty_req.ConcurrencyMode.JOIN_ALL
+        )
 
-def get_full_ind_class():
+    responses = sorted(asyncio.run(_run()), key=lambda response: int(response['meta']['tag']))
+
+    results = []
+    for response in responses:
+        # Like raise_for_status() on the httpx paths,
+        #   a failed request or a non-2xx status raises
+        # http_status is 0 when no response was received
+        status = response.get('http_status') or 0
+        exception = response.get('exception') or {}
+        if exception.get('type') or not 200 <= status < 300:
+            raise httpx.HTTPError(
+                f"Batch request failed with status {status}: {exception.get('message')}"
+            )
+        # The response envelope comes as a JSON string
+        #   holding the body as 'content' along with 'headers'
+        envelope = response['response']
+        if isinstance(envelope, (str, bytes)):
+            envelope = _json_loads(envelope)
+        results.append(_parse_response(envelope['content']))
+
+    return results
+
+
+@cached(TTLCache(maxsize=1, ttl=FULL_CACHE_TTL), lock=threading.Lock())
+def get_full_ind_class() -> Tuple[pandas.DataFrame, dict]:
     '''Gets full industry classification on VNDirect
+
+    The result is cached for FULL_CACHE_TTL seconds and shared
+    between callers; copy the DataFrame before mutating it
+    '''
+
+    # Bypass the per-query response cache
+    #   so that an expired result is actually refetched
+    content = _fetch_raw.__wrapped__((), (), (), "", "", MAX_QUERY_SIZE)
+
+    return _parse_response(content)
+
+
+class _PooledRequests:
+    '''Stands in for the requests module inside vnquant's loaders;
+    get and post go through the shared price session,
+    anything else is looked up on requests itself
     '''
 
-    return get_ind_class()
+    get = staticmethod(_PRICE_SESSION.get)
+    post = staticmethod(_PRICE_SESSION.post)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+_POOLED_REQUESTS = _PooledRequests()
+
+
+@contextlib.contextmanager
+def _pooled_requests():
+    '''Routes vnquant's requests.get and requests.post calls through
+    the shared price session for the duration of the block;
+    vnquant's loaders call these functions directly and do not accept
+    a session, so the `requests` global of its loaded modules is swapped,
+    leaving the requests module itself untouched
+    '''
+
+    global _PRICE_PATCH_COUNT
+    with _PRICE_PATCH_LOCK:
+        if _PRICE_PATCH_COUNT == 0:
+            _PRICE_PATCHED_MODULES[:] = [
+                module for name, module in list(sys.modules.items())
+                if name.split(".")[0] == "vnquant"
+                and getattr(module, 'requests', None) is requests
+            ]
+            for module in _PRICE_PATCHED_MODULES:
+                module.requests = _POOLED_REQUESTS
+        _PRICE_PATCH_COUNT += 1
+    try:
+        yield
+    finally:
+        with _PRICE_PATCH_LOCK:
+            _PRICE_PATCH_COUNT -= 1
+            if _PRICE_PATCH_COUNT == 0:
+                for module in _PRICE_PATCHED_MODULES:
+                    module.requests = requests
+                _PRICE_PATCHED_MODULES.clear()
+
 
 def get_price_from_ind_df(
         industry_df: pandas.DataFrame,
@@ -147,10 +621,19 @@ def get_price_from_ind_df(
             options are vnd (for VNDirect) or cafe (for CafeF)
     '''
 
-    # Get a list of strings of stock codes from the
+    # Get a list of unique stock codes from the
     #   `codeList` column of the provided DataFrame
     # Then pass that list into the DataLoader object
-    code_list = ",".join(list(industry_df['codeList'])).split(",")
+    code_list = (
+        industry_df['codeList']
+        .dropna()
+        .str.split(",")
+        .explode()
+        .str.strip()
+        .loc[lambda codes: codes != ""]
+        .unique()
+        .tolist()
+    )
     loader = vnd_loader.DataLoader(
         symbols=code_list,
         start=start,
@@ -158,7 +641,8 @@ def get_price_from_ind_df(
         minimal=minimal,
         data_source=data_source
     )
-    price_df = loader.download()
+    with _pooled_requests():
+        price_df = loader.download()
 
     return price_df
 